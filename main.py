@@ -1,20 +1,29 @@
 import os
-import io
 import asyncio
 import logging
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
 from dotenv import load_dotenv
 
+try:
+    import uvloop  # libuv 事件迴圈 (僅 Linux/macOS)
+except ImportError:
+    uvloop = None
+
 # 引入更新後的核心邏輯
 from scanner_core import scan_market, fetch_and_diagnose
 
 load_dotenv()
 TG_TOKEN = os.getenv('TG_TOKEN')
 TG_CHAT_ID = os.getenv('TG_CHAT_ID')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')        # 對外網址，有設定才改用 webhook 模式
+# 同時作為 URL path 與 Telegram secret token (webhook 模式必填)
+# Telegram 規定 secret token 只能是 1-256 個 A-Z a-z 0-9 _ - 字元
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+PORT = int(os.getenv('PORT', '8080'))
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -22,6 +31,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 指令格式 (模組載入時編譯一次，同時給 MessageHandler 過濾與解析使用)
+DIAG_PATTERN = re.compile(r'^/(\d{6})\s+(\S+).*$')  # /251225 2330 -> 診斷模式
+DATE_PATTERN = re.compile(r'^/(\d{6})$')              # /251225      -> 全掃描模式
+
+# --- 工具：掃描結果發送 ---
+def scan_file_name(formatted_date):
+    return f"TW_VCP_{formatted_date.replace('-','')}.txt"
+
+async def publish_results(bot, chat_id, results, file_name, caption, parse_mode=None):
+    """手動全掃描、診斷後全掃描、每日排程共用的結果發送流程"""
+    # 直接以 bytes + filename 上傳，不需要先包成 BytesIO 檔案物件
+    await bot.send_document(
+        chat_id=chat_id,
+        document="\n".join(results).encode('utf-8'),
+        filename=file_name,
+        caption=caption,
+        parse_mode=parse_mode
+    )
+
 # --- 背景任務：全市場掃描 (共用) ---
 async def run_full_scan_background(chat_id, context, date_str, formatted_date_msg):
     """
@@ -36,19 +64,9 @@ async def run_full_scan_background(chat_id, context, date_str, formatted_date_ms
             await context.bot.send_message(chat_id=chat_id, text=f"🤔 奇怪，全市場掃描無結果。")
             return
 
-        file_content = "\n".join(results)
-        bio = io.BytesIO(file_content.encode('utf-8'))
-        bio.name = f"TW_VCP_{formatted_date.replace('-','')}.txt"
-        
         caption = (f"✅ **{formatted_date} 全市場掃描完成**\n"
                    f"共篩選出 {len(results)} 檔標的")
-
-        await context.bot.send_document(
-            chat_id=chat_id,
-            document=bio,
-            caption=caption,
-            parse_mode='Markdown'
-        )
+        await publish_results(context.bot, chat_id, results, scan_file_name(formatted_date), caption, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Full scan failed: {e}")
         await context.bot.send_message(chat_id=chat_id, text=f"⚠️ 全市場掃描失敗: {e}")
@@ -96,25 +114,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # 處理 /251225 (純日期 -> 全掃描)
 async def history_scan_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    date_str = update.message.text.replace('/', '').strip()
+    date_str = context.matches[0].group(1)
     msg = await update.message.reply_text(f"⏳ 收到全掃描請求: {date_str}，運算中...")
     
-    # 這裡借用 run_full_scan_background 的邏輯，但需要微調參數傳遞
-    # 為了簡化，直接在這裡 create_task 調用原本的 scan_market 邏輯比較單純
     asyncio.create_task(run_scan_task_wrapper(update.effective_chat.id, msg.message_id, date_str, context))
 
 # 處理 /251225 2330 (日期 + 股號 -> 診斷)
 async def diagnostic_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # 解析輸入
-    text = update.message.text.replace('/', '').strip() # "251225 2330"
-    parts = text.split()
-    
-    if len(parts) < 2:
-        await update.message.reply_text("❌ 格式錯誤。請輸入: `/YYMMDD 代碼`")
-        return
-        
-    date_str = parts[0]
-    symbol = parts[1]
+    # Regex 過濾器已完成比對，直接取出 "251225", "2330"
+    date_str, symbol = context.matches[0].groups()
     
     msg = await update.message.reply_text(f"👨‍⚕️ 收到診斷請求: {symbol} 於 {date_str}...\n正在調閱病歷 (資料下載中)...")
     
@@ -128,7 +136,7 @@ async def diagnostic_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
     )
 
-# 舊的 wrapper，給 /251225 全掃描用的
+# /now 與 /251225 共用: 掃描後刪除進度訊息並送出結果檔
 async def run_scan_task_wrapper(chat_id, msg_id, date_str, context):
     try:
         results, formatted_date = await scan_market(date_str)
@@ -136,13 +144,9 @@ async def run_scan_task_wrapper(chat_id, msg_id, date_str, context):
             await context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=f"📅 {formatted_date}\n❌ 無符合標的。")
             return
 
-        file_content = "\n".join(results)
-        bio = io.BytesIO(file_content.encode('utf-8'))
-        bio.name = f"TW_VCP_{formatted_date.replace('-','')}.txt"
-        
         await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-        await context.bot.send_document(
-            chat_id=chat_id, document=bio, 
+        await publish_results(
+            context.bot, chat_id, results, scan_file_name(formatted_date),
             caption=f"✅ **{formatted_date} 掃描報告** ({len(results)}檔)"
         )
     except Exception as e:
@@ -152,42 +156,75 @@ async def now_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = await update.message.reply_text("🚀 掃描今日台股中...")
     asyncio.create_task(run_scan_task_wrapper(update.effective_chat.id, msg.message_id, None, context))
 
-# --- 排程任務 (維持不變) ---
+# --- 排程任務：每日 14:40 盤後掃描 ---
 async def scheduled_daily_scan(app):
     while True:
+        # 直接睡到下一個 14:40，不必每 20 秒醒來比對時間
         now = datetime.now()
-        if now.hour == 14 and now.minute == 40:
-            if TG_CHAT_ID:
-                await app.bot.send_message(chat_id=TG_CHAT_ID, text="⏰ 盤後掃描啟動...")
-                results, formatted_date = await scan_market(None)
-                if results:
-                    file_content = "\n".join(results)
-                    bio = io.BytesIO(file_content.encode('utf-8'))
-                    bio.name = f"Daily_{formatted_date}.txt"
-                    await app.bot.send_document(chat_id=TG_CHAT_ID, document=bio, caption=f"🌞 今日 VCP ({len(results)}檔)")
-                else:
-                    await app.bot.send_message(chat_id=TG_CHAT_ID, text="今日無符合標的。")
-            await asyncio.sleep(65)
-        await asyncio.sleep(20)
+        next_run = now.replace(hour=14, minute=40, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+        if TG_CHAT_ID:
+            await app.bot.send_message(chat_id=TG_CHAT_ID, text="⏰ 盤後掃描啟動...")
+            results, formatted_date = await scan_market(None)
+            if results:
+                await publish_results(app.bot, TG_CHAT_ID, results, f"Daily_{formatted_date}.txt", f"🌞 今日 VCP ({len(results)}檔)")
+            else:
+                await app.bot.send_message(chat_id=TG_CHAT_ID, text="今日無符合標的。")
+
+async def start_scheduler(application):
+    """post_init hook: 在 Application 自己的 event loop 上啟動每日排程 (polling / webhook 皆同)"""
+    # 保留 task 參照，避免被 GC 回收
+    application.bot_data['daily_scan_task'] = asyncio.create_task(scheduled_daily_scan(application))
 
 if __name__ == '__main__':
     if not TG_TOKEN:
         print("❌ Error: TG_TOKEN not found")
         exit(1)
 
-    app = ApplicationBuilder().token(TG_TOKEN).build()
+    # webhook 端點對外公開，沒有 secret 就無法驗證更新來源 (任何人都能偽造請求觸發全市場掃描)
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        print("❌ Error: WEBHOOK_SECRET is required when WEBHOOK_URL is set")
+        exit(1)
+    # 不合規的 secret 會讓 setWebhook 在啟動後才被 Telegram 拒絕，這裡先擋下
+    if WEBHOOK_URL and not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+        print("❌ Error: WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ or -")
+        exit(1)
+
+    # 在建立任何 event loop 之前換成 uvloop，polling 與排程都跑在同一個 loop 上
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # 所有 bot 呼叫統一經過限流器: 遵守全域 / 每群組速率上限，
+    # 遇到 429 依 retry_after 等待後重送，避免掃描結果發送到一半中斷
+    app = (
+        ApplicationBuilder()
+        .token(TG_TOKEN)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(start_scheduler)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("now", now_command))
     
     # 1. 先匹配 "日期 + 空格 + 代碼" 的格式 (診斷模式)
-    # Regex 解釋: ^/ 開頭, 6個數字, 至少一個空格, 接著任意字符
-    app.add_handler(MessageHandler(filters.Regex(r'^\/\d{6}\s+.+$'), diagnostic_handler))
+    app.add_handler(MessageHandler(filters.Regex(DIAG_PATTERN), diagnostic_handler))
     
     # 2. 再匹配 "純日期" 的格式 (全掃描模式)
-    app.add_handler(MessageHandler(filters.Regex(r'^\/\d{6}$'), history_scan_handler))
+    app.add_handler(MessageHandler(filters.Regex(DATE_PATTERN), history_scan_handler))
 
     print("🤖 Bot started...")
-    loop = asyncio.get_event_loop()
-    loop.create_task(scheduled_daily_scan(app))
-    app.run_polling()
+    if WEBHOOK_URL:
+        # webhook: 更新由 Telegram 直接推送，不必維持 long-poll 連線
+        app.run_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_SECRET}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        app.run_polling()
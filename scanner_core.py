@@ -1,10 +1,20 @@
 import requests
+import lxml.etree
+import lxml.html
+import numpy as np
 import pandas as pd
-import pandas_ta as ta
 import yfinance as yf
 import asyncio
 import traceback
 import math
+import functools
+import os
+import json
+import time
+import hashlib
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # ==========================================
@@ -14,59 +24,233 @@ VCP_LOOKBACK_DAYS = 10      # 觀察天數
 DEFAULT_TIGHTNESS = 0.035   # 一般盤整的容許震幅 (3.5%)
 GAP_THRESHOLD = 0.04        # 判定為跳空的門檻 (4%)
 MIN_VOLUME_AVG = 500000     # 最小均量 (500張)
+MIN_BARS = 65               # 最少有效 K 線數 (SMA60 + 5 天斜率)
+HISTORY_DAYS = 120          # 下載歷史的日曆天數 (需涵蓋 MIN_BARS 根交易日，含春節長假)
+PRICE_FIELDS = ('Open', 'Close', 'Volume')  # 篩選與診斷實際用到的欄位
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')  # 本地快取目錄 (行情)
+INTRADAY_CACHE_TTL = 600    # 含今日的行情快取有效秒數 (盤中資料會變動)
+DOWNLOAD_CACHE_MAX_AGE = 30 * 86400  # 行情快取檔最長保留秒數 (超過即清除，避免快取目錄無限成長)
+LISTING_CACHE_TTL = 86400   # 上市櫃清單快取有效秒數 (清單最多一天變動一次)
+DOWNLOAD_CONCURRENCY = 3    # 同時進行的批次下載數
 # ==========================================
 
 # --- A. 自動獲取上市櫃清單 ---
-def get_tw_stock_list():
-    """從證交所與櫃買中心獲取所有股票代碼，轉為 Yahoo 格式"""
+# 清單來源與 Yahoo 代碼後綴固定不變，模組載入時定義一次
+LISTING_SOURCES = (
+    ("https://isin.twse.com.tw/isin/C_public.jsp?strMode=2", ".TW"),   # 上市
+    ("https://isin.twse.com.tw/isin/C_public.jsp?strMode=4", ".TWO"),  # 上櫃
+)
+FALLBACK_TICKERS = ('2330.TW', '2317.TW', '2454.TW')  # 抓取失敗時的備援清單
+LISTING_TIMEOUT = 10  # 清單頁面請求逾時秒數
+
+# 清單頁面解析用的 XPath 預先編譯 (每列都會用到，不必逐列重新編譯)
+# 以表頭儲存格定位資料表: 頁面開頭還有只放標題 (<h2>) 的表格，不能直接取第一個 <table>
+LISTING_HEADER = '有價證券代號及名稱'
+LISTING_ROWS_XPATH = lxml.etree.XPath(
+    "//tr[*[self::td or self::th][normalize-space()=$header]]/ancestor::table[1]//tr"
+)
+HEADER_CELLS_XPATH = lxml.etree.XPath('./td|./th')
+ROW_CELLS_XPATH = lxml.etree.XPath('./td')
+
+# 共用 Session: 同一主機的連線 (含 TLS) 可重複使用，不必每次重新握手
+LISTING_SESSION = requests.Session()
+LISTING_SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+
+def fetch_listing(url, suffix):
+    """下載並解析單一清單頁面 (阻塞: HTTP + HTML 解析)，回傳 Yahoo 格式代碼"""
+    res = LISTING_SESSION.get(url, timeout=LISTING_TIMEOUT)
+    # 直接走 lxml 逐列取值，只留股票代碼，不必把整張表 (含 ETF、權證、債券) 建成 DataFrame
+    rows = LISTING_ROWS_XPATH(lxml.html.fromstring(res.text), header=LISTING_HEADER)
+    if not rows:
+        raise ValueError(f"清單頁面找不到表頭「{LISTING_HEADER}」: {url}")
+    header = [cell.text_content().strip() for cell in HEADER_CELLS_XPATH(rows[0])]
+    code_col = header.index(LISTING_HEADER)
+    type_col = header.index('有價證券別')
+
+    tickers = []
+    for row in rows[1:]:
+        cells = ROW_CELLS_XPATH(row)
+        if len(cells) != len(header): continue  # 分類標題列 (colspan 合併儲存格) 略過
+        if cells[type_col].text_content().strip() != '股票': continue
+        code = cells[code_col].text_content().split()[0]
+        if code.startswith('91'): continue  # 91 開頭為 DR (存託憑證)，解析時直接略過
+        tickers.append(code + suffix)
+    return tickers
+
+# 行程內清單快取 (取得時間, 清單): 同一行程重複掃描連檔案都不必讀
+LISTING_MEMO = {'fetched_at': 0.0, 'tickers': None}
+
+# --- Helper: 快取檔原子寫入 ---
+def write_atomic(path, dump):
+    """
+    dump(tmp_path) 寫入同目錄下的唯一暫存檔後再 os.replace 成 path
+    暫存檔名各自獨立 (mkstemp)，並行寫入者不會互相覆蓋寫到一半的檔案；失敗時清掉暫存檔
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
     try:
-        # 上市
-        url_twse = "https://isin.twse.com.tw/isin/C_public.jsp?strMode=2"
-        res_twse = requests.get(url_twse)
-        df_twse = pd.read_html(res_twse.text)[0]
-        df_twse.columns = df_twse.iloc[0]
-        df_twse = df_twse.iloc[1:]
-        df_twse = df_twse[df_twse['有價證券別'] == '股票']
-        stocks_twse = df_twse['有價證券代號及名稱'].apply(lambda x: x.split()[0] + ".TW").tolist()
-
-        # 上櫃
-        url_tpex = "https://isin.twse.com.tw/isin/C_public.jsp?strMode=4"
-        res_tpex = requests.get(url_tpex)
-        df_tpex = pd.read_html(res_tpex.text)[0]
-        df_tpex.columns = df_tpex.iloc[0]
-        df_tpex = df_tpex.iloc[1:]
-        df_tpex = df_tpex[df_tpex['有價證券別'] == '股票']
-        stocks_tpex = df_tpex['有價證券代號及名稱'].apply(lambda x: x.split()[0] + ".TWO").tolist()
-
-        full_list = stocks_twse + stocks_tpex
-        full_list = [s for s in full_list if not s.startswith('91')]
+        dump(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def dump_json(obj):
+    """回傳把 obj 以 JSON 寫入指定路徑的函式 (供 write_atomic 使用)"""
+    def dump(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f)
+    return dump
+
+async def get_tw_stock_list():
+    """
+    從證交所與櫃買中心獲取所有股票代碼，轉為 Yahoo 格式
+    LISTING_CACHE_TTL 內依序使用: 行程內快取 -> CACHE_DIR 檔案快取 -> 重新抓取
+    """
+    if LISTING_MEMO['tickers'] and time.time() - LISTING_MEMO['fetched_at'] < LISTING_CACHE_TTL:
+        return list(LISTING_MEMO['tickers'])
+
+    cache_path = os.path.join(CACHE_DIR, 'listing.json')
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < LISTING_CACHE_TTL:
+        try:
+            with open(cache_path, encoding='utf-8') as f:
+                tickers = json.load(f)
+            # 以檔案時間為準，行程內快取與檔案同時過期
+            LISTING_MEMO.update(fetched_at=os.path.getmtime(cache_path), tickers=tickers)
+            return list(tickers)
+        except Exception as e:
+            print(f"⚠️ 清單快取讀取失敗，改為重新抓取: {e}")
+
+    try:
+        # 上市、上櫃兩頁互不相依，各自在 worker thread 下載解析並同時進行
+        pages = await asyncio.gather(
+            *(asyncio.to_thread(fetch_listing, url, suffix) for url, suffix in LISTING_SOURCES)
+        )
+        # 去重 (保留原順序)，避免同一代碼在批次下載中重複請求
+        full_list = list(dict.fromkeys(s for page in pages for s in page))
         
         print(f"✅ 成功獲取 {len(full_list)} 檔台股清單")
-        return full_list
+
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            write_atomic(cache_path, dump_json(full_list))  # 原子替換，並行掃描不會讀到寫一半的檔案
+        except Exception as e:
+            print(f"⚠️ 清單快取寫入失敗: {e}")
+        LISTING_MEMO.update(fetched_at=time.time(), tickers=full_list)
+        return list(full_list)
     except Exception as e:
         print(f"❌ 獲取清單失敗: {e}")
-        return ['2330.TW', '2317.TW', '2454.TW']
+        return list(FALLBACK_TICKERS)
+
+# --- Helper: 日期區間解析 ---
+@functools.lru_cache(maxsize=512)
+def resolve_date_window(date_str):
+    """
+    'YYMMDD' -> (目標日, 下載起日, 下載迄日(不含), 'YYYY-MM-DD')
+    回測/診斷常重複查同一天，strptime 結果直接快取
+    """
+    target_date = datetime.strptime(date_str, "%y%m%d")
+    start_date = target_date - timedelta(days=HISTORY_DAYS)
+    end_date = target_date + timedelta(days=1)
+    return target_date, start_date, end_date, target_date.strftime('%Y-%m-%d')
+
+# --- Helper: 行情磁碟快取 ---
+def cached_download(tickers, start_date, end_date, fields=None, **kwargs):
+    """
+    包裝 yf.download，以 (代碼清單雜湊, 起訖日, 欄位, 下載參數) 為 key 快取於 CACHE_DIR
+    在區間結束 (end_date) 之後才寫入的快取資料不會再變動，直接沿用 (由 prune_download_cache 定期清除)；
+    區間尚未結束時寫入的 (可能含盤中資料) 只在 INTRADAY_CACHE_TTL 秒內重複使用
+    有代碼整欄缺值 (429 / 逾時) 的結果另存為 .partial.pkl，同樣只在 TTL 內沿用，不會被當成定案資料
+    fields: 只保留的欄位 (group_by='column' 的第一層)，在寫入快取前就丟掉用不到的 High / Low
+    """
+    key_src = "|".join(sorted(tickers)) + repr(fields) + repr(sorted(kwargs.items()))
+    key = hashlib.sha1(key_src.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, 'yf', f"{start_date:%Y%m%d}_{end_date:%Y%m%d}_{key}.pkl")
+    partial_path = path[:-len('.pkl')] + '.partial.pkl'
+
+    for cache_path, complete in ((path, True), (partial_path, False)):
+        if not os.path.exists(cache_path): continue
+        written_at = os.path.getmtime(cache_path)
+        # 同一區間隔天仍是同一個檔名，必須看寫入時間而非今天日期，盤中寫入的檔案才不會被當成定案資料
+        settled = complete and written_at >= end_date.timestamp()
+        if settled or time.time() - written_at < INTRADAY_CACHE_TTL:
+            try:
+                return pd.read_pickle(cache_path)
+            except Exception as e:
+                print(f"⚠️ 快取讀取失敗，改為重新下載: {e}")
+
+    data = yf.download(tickers, start=start_date, end=end_date, **kwargs)
+    if fields and isinstance(data.columns, pd.MultiIndex):
+        data = data.loc[:, data.columns.get_level_values(0).isin(fields)]
+
+    if not data.empty:
+        ticker_level = 0 if kwargs.get('group_by') == 'ticker' else 1
+        target_path = partial_path if missing_tickers(data, tickers, ticker_level) else path
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(target_path, data.to_pickle)
+        except Exception as e:
+            print(f"⚠️ 快取寫入失敗: {e}")
+
+    return data
+
+def missing_tickers(data, tickers, ticker_level=1):
+    """回傳下載結果中整欄缺值 (或根本沒有欄位) 的代碼；單一代碼的平面欄位只看是否全為缺值"""
+    if not isinstance(data.columns, pd.MultiIndex):
+        return set(tickers) if data.isna().all(axis=None) else set()
+    has_data = data.notna().any().to_numpy()
+    return set(tickers) - set(data.columns[has_data].get_level_values(ticker_level))
+
+def prune_download_cache(max_age=DOWNLOAD_CACHE_MAX_AGE):
+    """刪除 CACHE_DIR/yf 中超過 max_age 秒未更新的快取檔 (每次全市場掃描前執行)"""
+    cache_dir = os.path.join(CACHE_DIR, 'yf')
+    if not os.path.isdir(cache_dir): return
+
+    cutoff = time.time() - max_age
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError as e:
+            print(f"⚠️ 快取清除失敗: {e}")
+
+# 行情下載專用執行緒池: 同時最多 DOWNLOAD_CONCURRENCY 批 (超過的排隊)，
+# 也不會佔用篩選等其他 to_thread 工作所用的預設執行緒池
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix='yf-download')
+
+async def download_async(tickers, start_date, end_date, executor=DOWNLOAD_EXECUTOR):
+    """
+    在執行緒池上執行 cached_download (掃描與診斷共用同一組下載參數)
+    executor: 掃描批次用 DOWNLOAD_EXECUTOR 限流；傳 None 則走預設執行緒池 (單檔診斷不必排在掃描批次後面)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(
+        cached_download, tickers, start_date, end_date, PRICE_FIELDS,
+        group_by='column', progress=False, threads=True, auto_adjust=True
+    ))
 
 # --- Helper: Gap Reset 核心邏輯 (修正版: 取 Gap 與 DayMove 較大者) ---
-def apply_gap_reset_logic(df_slice, gap_threshold=GAP_THRESHOLD):
+def find_gap_reset(opens, closes, gap_threshold=GAP_THRESHOLD):
     """
-    輸入: DataFrame (包含 Open, Close)
+    輸入: 依日期排序的 Open / Close 陣列 (掃描直接傳入 ndarray，不必建 DataFrame)
     邏輯: 
       1. 判定是否跳空: (今日Open - 昨日Close) > 門檻
       2. 決定容許值基數: Max(跳空幅度, 當日收盤漲跌幅)
-    回傳: (截斷後的 Close Series, 是否跳空(bool), 跳空日期(str), 計算用幅度(float))
+    回傳: (跳空當日索引 (無跳空為 -1), 計算用幅度(float))
     """
-    df_slice = df_slice.sort_index()
-    
-    reset_idx = -1
-    magnitude_size = 0.0 # 用於回傳決定容許門檻的大小
+    # 逐日比較的是純量，轉成 list 後索引遠比逐次 .iloc 便宜
+    opens = opens.tolist()
+    closes = closes.tolist()
     
     # 從最後一天往回檢查
-    for i in range(len(df_slice) - 1, 0, -1):
+    for i in range(len(closes) - 1, 0, -1):
         
-        open_today = df_slice.iloc[i]['Open']
-        close_today = df_slice.iloc[i]['Close']
-        close_prev = df_slice.iloc[i-1]['Close']
+        open_today = opens[i]
+        close_today = closes[i]
+        close_prev = closes[i-1]
         
         if close_prev == 0: continue
             
@@ -75,99 +259,135 @@ def apply_gap_reset_logic(df_slice, gap_threshold=GAP_THRESHOLD):
         
         # 只有當「開盤跳空」成立時，才視為 Power Play 啟動
         if current_gap > gap_threshold:
-            reset_idx = i
-            
             # 2. 計算"當日收盤漲跌幅" (實體 K 棒幅度)
             current_day_move = abs((close_today - close_prev) / close_prev)
             
             # 3. 取兩者最大值作為「強度指標」
             # 若跳空 4.5% 但收盤漲 9.9%，則強度為 9.9% -> 容許門檻 10%
-            magnitude_size = max(current_gap, current_day_move)
-            
-            break
+            return i, max(current_gap, current_day_move)
             
-    if reset_idx != -1:
-        cutoff_date = df_slice.index[reset_idx]
-        new_series = df_slice['Close'].iloc[reset_idx:]
-        return new_series, True, cutoff_date.strftime('%Y-%m-%d'), magnitude_size
-    
-    return df_slice['Close'], False, None, 0.0
+    return -1, 0.0
+
+# --- Helper: 尾端均線 ---
+def sma_tail(arr, length, offset=0):
+    """
+    只取 offset 天前那一天的 SMA(length) 值 (offset=0 為最新一天)
+    arr 可為單檔 1 維陣列或 (K棒, 代碼) 矩陣 (逐欄計算)，不必產生整條 rolling Series
+    """
+    end = len(arr) - offset
+    return arr[end - length:end].mean(axis=0)
 
 # --- B. VCP 判斷邏輯 (大量掃描用) ---
 def check_vcp_criteria(df):
     """
     大量掃描專用函數
     """
-    if len(df) < 65: return False
-    
-    close = df['Close']
-    vol = df['Volume']
+    if len(df) < MIN_BARS: return False
     
-    # 1. 趨勢濾網
-    sma60 = ta.sma(close, length=60)
-    if sma60 is None or len(sma60.dropna()) < 5: return False
+    # 只需尾端少數數值，一次轉成 float64 ndarray (已是 float64 時不複製) 直接切片計算
+    close = df['Close'].to_numpy(np.float64, copy=False)
+    vol = df['Volume'].to_numpy(np.float64, copy=False)
     
-    if pd.isna(sma60.iloc[-1]) or pd.isna(sma60.iloc[-5]): return False
-    if close.iloc[-1] < sma60.iloc[-1]: return False
-    if sma60.iloc[-1] <= sma60.iloc[-5]: return False
-
-    # ====================================================
-    # 2. VCP Tightness (含動態門檻)
-    # ====================================================
-    recent_df = df.tail(VCP_LOOKBACK_DAYS)
-    effective_closes, is_reset, _, magnitude_size = apply_gap_reset_logic(recent_df)
-    
-    if len(effective_closes) < 3: return False
+    # 濾網順序與批次篩選相同: 只看成交量的先做 (淘汰率最高)，逐日迴圈的跳空檢查 (最貴) 放最後
+    # (診斷報告仍依 趨勢 -> 收斂 -> 量能 的順序呈現)
+    # 1. 流動性濾網 (20 日均量)
+    vol_sma20 = sma_tail(vol, 20)
+    if vol_sma20 < MIN_VOLUME_AVG: return False
 
-    if is_reset:
+    # 2. 成交量 VCP
+    if vol_sma20 >= sma_tail(vol, 60): return False
+
+    # 3. 趨勢濾網 (先比今日 SMA60，通過才計算 4 天前的 SMA60)
+    sma60_now = sma_tail(close, 60)
+    if math.isnan(sma60_now) or close[-1] < sma60_now: return False
+
+    sma60_prev = sma_tail(close, 60, 4)
+    if math.isnan(sma60_prev) or sma60_now <= sma60_prev: return False
+
+    # 4. VCP Tightness (含動態門檻)
+    opens = df['Open'].to_numpy(np.float64, copy=False)
+    return check_tightness(opens[-VCP_LOOKBACK_DAYS:], close[-VCP_LOOKBACK_DAYS:], close[-1])
+
+# 收斂檢查的中間數值，掃描判斷與診斷報告共用同一份計算
+TightnessMetrics = namedtuple('TightnessMetrics', 'reset_idx magnitude_size effective_days range_pct threshold')
+
+def tightness_metrics(opens, closes, current_c):
+    """
+    VCP Tightness 指標 (含動態門檻)
+    輸入: 最近 VCP_LOOKBACK_DAYS 根 K 棒的 Open / Close 陣列與今日收盤
+    回傳: TightnessMetrics (reset_idx 為 -1 表示無跳空)
+    """
+    reset_idx, magnitude_size = find_gap_reset(opens, closes)
+    effective_closes = closes[reset_idx:] if reset_idx != -1 else closes
+
+    if reset_idx != -1:
         # 使用回傳的 magnitude_size (已取最大值) 進行無條件進位
         dynamic_threshold = math.ceil(magnitude_size * 100) / 100.0
     else:
         dynamic_threshold = DEFAULT_TIGHTNESS
 
-    max_c = effective_closes.max()
-    min_c = effective_closes.min()
-    current_c = close.iloc[-1]
-    
-    range_pct = (max_c - min_c) / current_c
+    range_pct = np.ptp(effective_closes) / current_c  # 最高 - 最低收盤
     
-    if range_pct > dynamic_threshold: return False
+    return TightnessMetrics(reset_idx, magnitude_size, len(effective_closes), range_pct, dynamic_threshold)
 
-    # 3. 成交量 VCP
-    vol_sma20 = vol.tail(20).mean()
-    vol_sma60 = vol.tail(60).mean()
-    if vol_sma20 >= vol_sma60: return False
-    
-    # 4. 流動性濾網
-    if vol_sma20 < MIN_VOLUME_AVG: return False
-
-    return True
+def batch_tightness(opens, closes):
+    """
+    整批版 VCP Tightness: 輸入 (VCP_LOOKBACK_DAYS, 代碼) 的 Open / Close 矩陣，回傳逐欄通過與否
+    與 tightness_metrics + check_tightness 逐欄結果相同 (最後一次跳空、門檻進位、跳空後至少 3 天)
+    """
+    n_days = closes.shape[0]
+    cols = np.arange(closes.shape[1])
+    prev = closes[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gaps = np.abs((opens[1:] - prev) / prev)
+        moves = np.abs((closes[1:] - prev) / prev)
+    hits = (prev != 0) & (gaps > GAP_THRESHOLD)
+
+    # 每欄最後一次跳空 (由後往前第一個命中)；gaps 第 k 列對應 K 棒 k+1
+    is_reset = hits.any(axis=0)
+    last_hit = (n_days - 2) - hits[::-1].argmax(axis=0)
+    start = np.where(is_reset, last_hit + 1, 0)
+
+    magnitude_size = np.maximum(gaps[last_hit, cols], moves[last_hit, cols])
+    with np.errstate(invalid='ignore'):
+        dynamic_threshold = np.where(is_reset, np.ceil(magnitude_size * 100) / 100.0, DEFAULT_TIGHTNESS)
+
+    # 只取跳空後 (含當日) 的收盤計算震幅
+    in_window = np.arange(n_days)[:, None] >= start
+    range_val = np.where(in_window, closes, -np.inf).max(axis=0) - np.where(in_window, closes, np.inf).min(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        range_pct = range_val / closes[-1]
+
+    return (n_days - start >= 3) & (range_pct <= dynamic_threshold)
+
+def check_tightness(opens, closes, current_c):
+    """
+    VCP Tightness 判斷: 跳空後至少 3 天，且震幅不超過門檻
+    """
+    m = tightness_metrics(opens, closes, current_c)
+    return m.effective_days >= 3 and m.range_pct <= m.threshold
 
 # --- C. 單一股票診斷邏輯 (詳細報告用) ---
 def diagnose_single_stock(df, symbol):
     """
     產生詳細診斷報告
+    輸入: 已 dropna 的單檔 DataFrame (由 fetch_and_diagnose 清理)
     """
     report = []
     is_pass = True
     
-    df = df.dropna()
-    if len(df) < 65:
+    if len(df) < MIN_BARS:
         return False, f"❌ 資料不足: 有效 K 線僅 {len(df)} 根"
 
-    try:
-        close = df['Close'].astype(float)
-        vol = df['Volume'].astype(float)
-    except Exception as e:
-        return False, f"❌ 數據格式錯誤: {e}"
-    
-    c_now = close.iloc[-1]
+    # 各項檢查共用同一份 float64 陣列 (yfinance 已是 float64 時不複製)，尾端切片求值不再建立新的 Series
+    # 非數值資料會在此直接拋出，由 fetch_and_diagnose 的例外處理回報
+    close_arr = df['Close'].to_numpy(np.float64, copy=False)
+    vol_arr = df['Volume'].to_numpy(np.float64, copy=False)
+    c_now = close_arr[-1]
     
-    # 1. 趨勢檢查
-    sma60 = ta.sma(close, length=60)
-    if sma60 is None: return False, "❌ 無法計算 MA"
-    ma60_now = sma60.iloc[-1]
-    ma60_prev = sma60.iloc[-5]
+    # 1. 趨勢檢查 (與掃描相同: 直接對尾端切片求 SMA60 今日值與 4 天前值)
+    ma60_now = sma_tail(close_arr, 60)
+    ma60_prev = sma_tail(close_arr, 60, 4)
     
     report.append(f"🔹 **Trend (趨勢)**")
     if c_now > ma60_now:
@@ -182,47 +402,42 @@ def diagnose_single_stock(df, symbol):
         report.append(f"   ❌ 季線下彎")
         is_pass = False
 
-    # 2. VCP Tightness 檢查
-    recent_df = df.tail(VCP_LOOKBACK_DAYS)
-    effective_closes, is_reset, reset_date, magnitude_size = apply_gap_reset_logic(recent_df)
-    
-    max_c = effective_closes.max()
-    min_c = effective_closes.min()
-    range_val = max_c - min_c
-    range_pct = range_val / c_now
+    # 2. VCP Tightness 檢查 (與掃描共用 tightness_metrics)
+    recent_idx = df.index[-VCP_LOOKBACK_DAYS:]
+    opens_arr = df['Open'].to_numpy(np.float64, copy=False)
+    tight = tightness_metrics(opens_arr[-VCP_LOOKBACK_DAYS:], close_arr[-VCP_LOOKBACK_DAYS:], c_now)
+    is_reset = tight.reset_idx != -1
     
     # 設定顯示變數
     if is_reset:
-        dynamic_threshold = math.ceil(magnitude_size * 100) / 100.0
-        thresh_str = f"{dynamic_threshold*100:.0f}% (Power Play 動態調整)"
+        thresh_str = f"{tight.threshold*100:.0f}% (Power Play 動態調整)"
     else:
-        dynamic_threshold = DEFAULT_TIGHTNESS
-        thresh_str = f"{dynamic_threshold*100:.1f}% (標準 VCP 設定)"
+        thresh_str = f"{tight.threshold*100:.1f}% (標準 VCP 設定)"
 
     report.append(f"\n🔹 **Tightness (收斂)**")
     if is_reset:
         report.append(f"   ⚡ **偵測到跳空 (Power Play)**")
-        report.append(f"   ℹ️ 跳空日期: {reset_date}")
-        report.append(f"   ℹ️ 當日最大幅度(Gap vs Move): {magnitude_size*100:.2f}%")
-        report.append(f"   ℹ️ 重置後計算區間: {len(effective_closes)} 天")
+        report.append(f"   ℹ️ 跳空日期: {recent_idx[tight.reset_idx].strftime('%Y-%m-%d')}")
+        report.append(f"   ℹ️ 當日最大幅度(Gap vs Move): {tight.magnitude_size*100:.2f}%")
+        report.append(f"   ℹ️ 重置後計算區間: {tight.effective_days} 天")
     else:
         report.append(f"   ℹ️ 一般盤整模式 (近 {VCP_LOOKBACK_DAYS} 天無顯著缺口)")
 
-    report.append(f"   ℹ️ 實際震幅: {range_pct*100:.2f}%")
+    report.append(f"   ℹ️ 實際震幅: {tight.range_pct*100:.2f}%")
     report.append(f"   ℹ️ 容許門檻: {thresh_str}")
     
-    if len(effective_closes) < 3:
+    if tight.effective_days < 3:
         report.append(f"   ❌ 跳空後天數過短 (<3天)，形態未確認")
         is_pass = False
-    elif range_pct <= dynamic_threshold:
+    elif tight.range_pct <= tight.threshold:
         report.append(f"   ✅ 符合標準")
     else:
         report.append(f"   ❌ 震幅過大 (超標)")
         is_pass = False
 
     # 3. 成交量檢查
-    vol_sma20 = vol.tail(20).mean()
-    vol_sma60 = vol.tail(60).mean()
+    vol_sma20 = sma_tail(vol_arr, 20)
+    vol_sma60 = sma_tail(vol_arr, 60)
     
     report.append(f"\n🔹 **Volume (成交量)**")
     if vol_sma20 < vol_sma60:
@@ -241,56 +456,111 @@ def diagnose_single_stock(df, symbol):
     final_msg = "\n".join(report)
     return is_pass, final_msg
 
+# --- Helper: 單批下載結果篩選 ---
+def screen_batch(data, batch, target_day):
+    """
+    輸入: yf.download(group_by='column') 的整批結果 (欄位, 代碼)，data['Close'] 即 (K棒, 代碼) 矩陣
+    回傳: 該批中最後交易日為 target_day 且通過 VCP 的代碼
+
+    最近 MIN_BARS 根 K 棒完整無缺的代碼 (絕大多數)，先對 (K棒, 代碼) 成交量矩陣篩量縮 / 流動性，
+    倖存欄位再算季線趨勢，最後整批做跳空收斂檢查。
+    其餘 (停牌、新上市、當日無資料) 退回逐檔 dropna + check_vcp_criteria，結果一致。
+    """
+    # 欄位結構整批相同，迴圈外判斷一次即可
+    if data.empty or not isinstance(data.columns, pd.MultiIndex): return []
+
+    # 整批都沒有目標日這一列 (休市日、未來日期)：任何代碼都不可能通過，直接結束
+    on_target = data.index.date == target_day
+    if not on_target.any(): return []
+
+    passed = []
+    fast_symbols = []
+    if len(data) >= MIN_BARS and data.index[-1].date() == target_day:
+        complete = data.iloc[-MIN_BARS:].notna().all().groupby(level=1).all()
+        fast_symbols = [s for s in batch if complete.get(s, False)]
+
+    if fast_symbols:
+        tail = data.iloc[-MIN_BARS:]
+        vol = tail['Volume'][fast_symbols].to_numpy()
+
+        # 第一關: 量縮 + 流動性 (只看成交量)，多數代碼在此淘汰
+        vol_sma20 = sma_tail(vol, 20)
+        vol_sma60 = sma_tail(vol, 60)
+        keep = np.flatnonzero((vol_sma20 < vol_sma60) & (vol_sma20 >= MIN_VOLUME_AVG))
+        survivors = [fast_symbols[j] for j in keep]
+
+        # 第二關: 只對倖存欄位取收盤矩陣算季線趨勢
+        close = tail['Close'][survivors].to_numpy()
+        sma60_now = sma_tail(close, 60)
+        sma60_prev = sma_tail(close, 60, 4)
+        trend = (close[-1] >= sma60_now) & (sma60_now > sma60_prev)
+
+        # 第三關: 跳空收斂檢查，趨勢倖存欄位整批一次計算
+        survivors = [survivors[j] for j in np.flatnonzero(trend)]
+        recent = tail.iloc[-VCP_LOOKBACK_DAYS:]
+        tight = batch_tightness(
+            recent['Open'][survivors].to_numpy(np.float64),
+            recent['Close'][survivors].to_numpy(np.float64),
+        )
+        passed += [survivors[j] for j in np.flatnonzero(tight)]
+
+    fast_set = set(fast_symbols)
+    # 整批一次算好的預篩 (免建逐檔 DataFrame):
+    #   有效收盤數不足 MIN_BARS、或目標日沒有收盤價者，dropna 後必定不過
+    closes = data['Close']
+    close_counts = closes.count()
+    has_target_close = closes.loc[on_target].notna().any()
+    for symbol in batch:
+        if symbol in fast_set: continue
+        if close_counts.get(symbol, 0) < MIN_BARS or not has_target_close.get(symbol, False): continue
+        try:
+            # 只讀不寫，dropna 的結果直接使用 (yfinance 欄名已是 Open / Close / Volume)
+            df = data.xs(symbol, axis=1, level=1).dropna()
+            if df.empty: continue
+            
+            if df.index[-1].date() != target_day: continue
+            
+            if check_vcp_criteria(df):
+                passed.append(symbol)
+        except Exception:
+            continue
+
+    # 維持原本批次內的代碼順序
+    passed = set(passed)
+    return [s for s in batch if s in passed]
+
 # --- D. 執行掃描主程式 (大量) ---
 async def scan_market(target_date_str):
     try:
-        if target_date_str:
-            target_date = datetime.strptime(target_date_str, "%y%m%d")
-        else:
-            target_date = datetime.now()
-        
-        start_date = target_date - timedelta(days=250)
-        end_date = target_date + timedelta(days=1)
-        formatted_date = target_date.strftime('%Y-%m-%d')
+        target_date, start_date, end_date, formatted_date = resolve_date_window(
+            target_date_str or datetime.now().strftime("%y%m%d")
+        )
         print(f"🚀 開始掃描: {formatted_date}")
 
-        tickers = get_tw_stock_list()
+        tickers = await get_tw_stock_list()
+        await asyncio.to_thread(prune_download_cache)
         
         batch_size = 200
-        valid_symbols = []
+        target_day = target_date.date()  # 所有代碼共用同一交易日曆，不必每檔重算
 
-        for i in range(0, len(tickers), batch_size):
-            batch = tickers[i:i+batch_size]
+        async def scan_batch(batch):
             try:
-                data = yf.download(batch, start=start_date, end=end_date, group_by='ticker', progress=False, threads=True, auto_adjust=True)
+                # 下載 (含快取讀寫) 是同步 I/O，在下載專用執行緒池執行，避免卡住 bot 的 event loop；
+                # 池的大小即同時下載的批次數上限，避免對 Yahoo 發出過多並行請求
+                data = await download_async(batch, start_date, end_date)
                 
-                if data.empty: continue
-
-                for symbol in batch:
-                    try:
-                        if isinstance(data.columns, pd.MultiIndex):
-                            df = data[symbol].copy()
-                        else:
-                            continue
-
-                        df.columns = [c.capitalize() for c in df.columns]
-                        df.dropna(inplace=True)
-                        if df.empty: continue
-                        
-                        last_dt = df.index[-1].date()
-                        if last_dt != target_date.date(): continue
-                        
-                        if check_vcp_criteria(df):
-                            valid_symbols.append(symbol)
-                    except Exception:
-                        continue
-                
-                await asyncio.sleep(0.5)
+                # 篩選是純 CPU 運算，交給預設 worker thread；下載池已空出，下一批可同時下載
+                return await asyncio.to_thread(screen_batch, data, batch, target_day)
                 
             except Exception as e:
                 print(f"⚠️ Batch download error: {e}")
-                continue
+                return []
+
+        batches = [tickers[i:i+batch_size] for i in range(0, len(tickers), batch_size)]
+        results = await asyncio.gather(*(scan_batch(batch) for batch in batches))
 
+        # gather 依輸入順序回傳，結果維持原本清單順序
+        valid_symbols = [s for batch_result in results for s in batch_result]
         return valid_symbols, formatted_date
 
     except Exception as e:
@@ -300,35 +570,37 @@ async def scan_market(target_date_str):
 # --- E. 執行單一股票下載與診斷 ---
 async def fetch_and_diagnose(symbol_input, date_str):
     try:
-        target_date = datetime.strptime(date_str, "%y%m%d")
-        start_date = target_date - timedelta(days=250)
-        end_date = target_date + timedelta(days=1)
-        formatted_date = target_date.strftime('%Y-%m-%d')
+        target_date, start_date, end_date, formatted_date = resolve_date_window(date_str)
 
         symbol = symbol_input.upper().strip()
         if not (symbol.endswith('.TW') or symbol.endswith('.TWO')):
-            test_symbol = f"{symbol}.TW"
+            # 未指定市場: 上市/上櫃一次批次下載，省去失敗後重試的第二趟請求
+            candidates = [f"{symbol}.TW", f"{symbol}.TWO"]
         else:
-            test_symbol = symbol
-
-        print(f"Debug: Downloading {test_symbol}...")
-        df = yf.download(test_symbol, start=start_date, end=end_date, progress=False, auto_adjust=True)
-        
-        if df.empty and not (symbol.endswith('.TW') or symbol.endswith('.TWO')):
-            test_symbol = f"{symbol}.TWO"
-            print(f"Debug: Retrying with {test_symbol}...")
-            df = yf.download(test_symbol, start=start_date, end=end_date, progress=False, auto_adjust=True)
+            candidates = [symbol]
+
+        print(f"Debug: Downloading {', '.join(candidates)}...")
+        # 不排進掃描用的 DOWNLOAD_EXECUTOR，全市場掃描進行中也能立即回應診斷
+        data = await download_async(candidates, start_date, end_date, executor=None)
+
+        test_symbol = candidates[0]
+        df = pd.DataFrame()
+        if not data.empty:
+            for cand in candidates:
+                if isinstance(data.columns, pd.MultiIndex):
+                    if cand not in data.columns.get_level_values(1): continue
+                    sub = data.xs(cand, axis=1, level=1)
+                else:
+                    sub = data
+                sub = sub.dropna(how='all')
+                if not sub.empty:
+                    test_symbol, df = cand, sub
+                    break
 
         if df.empty:
             return False, f"❌ 找不到股票數據: {symbol_input}", formatted_date
 
-        if isinstance(df.columns, pd.MultiIndex):
-            df.columns = df.columns.get_level_values(0)
-        
-        df.columns = [c.capitalize() for c in df.columns]
-        
-        required_cols = ['Close', 'High', 'Low', 'Volume', 'Open']
-        if not all(col in df.columns for col in required_cols):
+        if not all(col in df.columns for col in PRICE_FIELDS):
              return False, f"❌ 數據欄位缺失: {list(df.columns)}", formatted_date
 
         df.dropna(inplace=True)